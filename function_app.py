@@ -2,22 +2,144 @@ import azure.functions as func
 import logging
 import json
 import base64
-import fitz  # PyMuPDF
+import atexit
+import re
+import time
 from io import BytesIO
 import traceback
-from PyPDF2 import PdfReader, PdfWriter
-from PyPDF2.generic import TextStringObject
-from PyPDF2.generic import DictionaryObject, NameObject, BooleanObject, ArrayObject
-from collections import defaultdict
+import os
+import hashlib
+import math
+import threading
+import zipfile
+import zlib
+import tempfile
+from collections import defaultdict, OrderedDict
+
+# PDF engines are imported on first use by load_fitz() / load_pypdf2() so cold starts
+# only pay for the engine a route actually needs
+fitz = None  # PyMuPDF
+PdfReader = PdfWriter = None
+TextStringObject = DictionaryObject = NameObject = BooleanObject = ArrayObject = None
+
+# Import & initialization time of each engine in ms, reported by the prewarm route
+engine_timings = {}
+engine_lock = threading.Lock()
 
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
+def load_fitz():
+    """
+    Import PyMuPDF on first use and record how long the import took.
+    """
+    global fitz
+    with engine_lock:
+        if fitz is None:
+            start = time.perf_counter()
+            import fitz  # PyMuPDF
+            engine_timings["fitz_import_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return fitz
+
+def load_pypdf2():
+    """
+    Import PyPDF2 on first use and record how long the import took.
+    """
+    global PdfReader, PdfWriter, TextStringObject, DictionaryObject, NameObject, BooleanObject, ArrayObject
+    with engine_lock:
+        if PdfReader is None:
+            start = time.perf_counter()
+            from PyPDF2 import PdfReader, PdfWriter
+            from PyPDF2.generic import TextStringObject
+            from PyPDF2.generic import DictionaryObject, NameObject, BooleanObject, ArrayObject
+            engine_timings["pypdf2_import_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+# Worker processes for CPU-bound MuPDF work (MuPDF is not thread safe), shared by all requests
+PROCESS_POOL_MAX_TASKS_PER_CHILD = 20  # Workers are replaced after this many tasks, see recompress_image (~2 MB leaked per A4 scan)
+process_pool = None
+process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    """
+    Return the shared worker process pool, creating it on first use.
+    Workers are spawned rather than forked: the host runs requests on threads, and a child
+    forked while another thread holds engine_lock would deadlock in load_fitz().
+    Workers are recycled after PROCESS_POOL_MAX_TASKS_PER_CHILD tasks.
+    """
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            process_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=PROCESS_POOL_MAX_TASKS_PER_CHILD
+            )
+            # Shut the workers down while the interpreter is still intact
+            atexit.register(process_pool.shutdown)
+    return process_pool
+
+def warm_worker():
+    """
+    Trivial pool task that imports fitz in a worker process. Returns the worker's pid.
+    """
+    load_fitz()
+    return os.getpid()
+
+
+
+@app.route(route="prewarm")
+def prewarm(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        engines_were_loaded = {"fitz": fitz is not None, "pypdf2": PdfReader is not None}
+        
+        # No route runs PyPDF2 code anymore, so only fitz is loaded; pypdf2 is just reported
+        load_fitz()
+        
+        # Exercise fitz once so font, colorspace & parser setup also happens before traffic
+        start = time.perf_counter()
+        with fitz.open() as doc:
+            page = doc.new_page()
+            page.insert_text((72, 72), "prewarm")
+            page.get_text()
+            page.get_pixmap(dpi=THUMBNAIL_DEFAULT_DPI)
+            doc.tobytes()
+        engine_timings["fitz_init_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        
+        # Spawn the shared pool's workers & import fitz in each, so the first parallel thumbnail
+        # or image request doesn't pay for it. One task per worker makes the pool start all of them
+        start = time.perf_counter()
+        pool = get_process_pool()
+        futures = [pool.submit(warm_worker) for _ in range(os.cpu_count() or 1)]
+        worker_pids = {future.result() for future in futures}
+        engine_timings["process_pool_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        
+        response_data = {
+            "ready": True,
+            "engines_were_loaded": engines_were_loaded,
+            "pool_workers": len(worker_pids),
+            "timings_ms": engine_timings
+        }
+        
+        return func.HttpResponse(
+            body=json.dumps(response_data),
+            mimetype="application/json",
+            status_code=200
+        )
+    except Exception as e:
+        logging.exception(f"An error occurred: {str(e)}\n\nTraceback:\n{traceback.format_exc()}")
+        return func.HttpResponse(
+            f"Error: {str(e)}\n\nTraceback:\n{traceback.format_exc()}",
+            status_code=500
+        )
+
 
 
 @app.route(route="detect_pdf_text_layer")
 def detect_pdf_text_layer(req: func.HttpRequest) -> func.HttpResponse:
     try:
+        load_fitz()
         req_json = req.get_json()
         pdf_bytes = base64_to_pdf(req_json['file_content'].get('$content'))
         
@@ -47,17 +169,17 @@ def pdf_text_layer_info(pdf_bytes: bytes) -> tuple:
     Check if any page in the PDF contains a text layer and if all pages have a text layer.
     Returns (text_layer_found, all_pages_have_text_layer).
     """
-    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-    any_text_layer = False
-    all_text_layer = True
-    
-    for page_num in range(len(pdf_document)):
-        page = pdf_document.load_page(page_num)
-        text = page.get_text()
-        if text.strip():
-            any_text_layer = True
-        else:
-            all_text_layer = False
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        any_text_layer = False
+        all_text_layer = True
+        
+        for page_num in range(len(pdf_document)):
+            page = pdf_document.load_page(page_num)
+            text = page.get_text()
+            if text.strip():
+                any_text_layer = True
+            else:
+                all_text_layer = False
     
     return any_text_layer, all_text_layer
 
@@ -69,6 +191,8 @@ def pdf_text_layer_info(pdf_bytes: bytes) -> tuple:
 @app.route(route="merge_pdf_pypdf2")
 def merge_pdf_pypdf2(req: func.HttpRequest) -> func.HttpResponse:
     try:
+        # merge_pdfs resolves to the fitz version defined further down, so PyPDF2 isn't loaded here
+        load_fitz()
         pdf_base64_strings_list = [item.get('$content') for item in req.get_json()['file_content']]
         merged_pdf_base64_string = merge_pdfs(pdf_base64_strings_list)
 
@@ -151,21 +275,35 @@ def merge_pdfs(pdf_base64_list):
 @app.route(route="merge_pdf_fitz")
 def merge_pdf_fitz(req: func.HttpRequest) -> func.HttpResponse:
     try:
+        load_fitz()
         # Form an array of base64 strings of the pdfs to merge from the $content parameters & call the merge_pdfs function on that array
-        pdf_base64_strings_list = [item.get('$content') for item in req.get_json()['file_content']]
-        merged_pdf_base64_string = merge_pdfs(pdf_base64_strings_list)
+        req_json = req.get_json()
+        pdf_base64_strings_list = [item.get('$content') for item in req_json['file_content']]
+        # Optional manifest of {"input", "pages", "rotate"} entries to subset, reorder & rotate pages in the same pass
+        manifest = req_json.get('manifest')
+        # Optional fast web view output so browsers can show page 1 before the whole file arrives
+        linearize = bool(req_json.get('linearize', False))
+        # Optional downsampling & recompression of high resolution images (e.g. scans)
+        image_options = parse_image_options(req_json.get('downsample_images'))
+        image_report = []
+        merged_pdf_base64_string = merge_pdfs(pdf_base64_strings_list, manifest, linearize, image_options, image_report)
         
         ###HTTP response for MERGE operation###
         # Return the merged pdf base64 string in a Power Automate content object in an HTTP response
+        # The image report (one entry per input file) goes in a header to keep the content object as is
         return func.HttpResponse(
         body=json.dumps({
             "$content-type": "application/pdf",
             "$content": merged_pdf_base64_string
             }),
         mimetype="application/json",
+        headers={"X-Image-Report": json.dumps(image_report)} if image_options else None,
         status_code=200
         )              
     
+    except ValueError as e:
+        # Bad input: invalid base64 or PDF signature, manifest or image options
+        return func.HttpResponse(f"Invalid. {str(e)}", status_code=400)
     except Exception as e:
         # If there is an error, log the error & then return the error message in an HTTP response
         debug_error = logging.exception(f"An error occurred: {str(e)}\n\nTraceback:\n{traceback.format_exc()}")
@@ -181,43 +319,77 @@ def base64_to_pdf(base64_string):
         raise ValueError("Missing the PDF file signature")
     return file_bytes
 
-def merge_pdfs(pdf_base64_list):
-    result = fitz.open()
-    
-    # First step: collect all form field values from all PDFs
+def parse_page_ranges(page_ranges, page_count):
+    """
+    Convert manifest page ranges (1-based) into 0-based (from_page, to_page) tuples.
+    Accepts ints (7), strings ("3-5", "9-2" for reversed order) or [start, end] pairs.
+    A missing range list (None) selects the whole document.
+    """
+    if page_ranges is None:
+        return [(0, page_count - 1)]
+
+    if not isinstance(page_ranges, list):
+        page_ranges = [page_ranges]
+    if not page_ranges:
+        raise ValueError("Page range list is empty, leave out 'pages' to take the whole document")
+
+    result = []
+    for page_range in page_ranges:
+        if isinstance(page_range, bool):
+            raise ValueError(f"Invalid page range '{page_range}'")
+        elif isinstance(page_range, int):
+            start = end = page_range
+        elif isinstance(page_range, str):
+            parts = page_range.split("-")
+            if len(parts) not in (1, 2) or not all(part.strip().isdigit() for part in parts):
+                raise ValueError(f"Invalid page range '{page_range}'")
+            start, end = int(parts[0]), int(parts[-1])
+        elif isinstance(page_range, list) and len(page_range) == 2 and all(type(page) is int for page in page_range):
+            start, end = page_range
+        else:
+            raise ValueError(f"Invalid page range '{page_range}'")
+
+        if not (1 <= start <= page_count and 1 <= end <= page_count):
+            raise ValueError(f"Page range '{page_range}' is outside of 1-{page_count}")
+        result.append((start - 1, end - 1))
+
+    return result
+
+def collect_form_values(docs):
+    """
+    Collect the form field values of all documents, later documents win on duplicate names.
+    Radio buttons only count when selected.
+    """
     all_form_values = {}
     
-    for pdf_base64 in pdf_base64_list:
-        pdf_bytes = base64_to_pdf(pdf_base64)
-        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-            # Get form field values using the correct method name
-            field_data = {}
-            for page in doc:
-                for widget in page.widgets():
-                    if widget.field_name:
-                        # Only store if this has a value
-                        if widget.field_type == fitz.PDF_WIDGET_TYPE_RADIOBUTTON:
-                            # For radio buttons, we need to check if it's selected
-                            if hasattr(widget, 'field_flags') and (widget.field_flags & 2**15):
-                                field_data[widget.field_name] = widget.field_value
-                        else:
+    for doc in docs:
+        # Get form field values using the correct method name
+        field_data = {}
+        for page in doc:
+            for widget in page.widgets():
+                if widget.field_name:
+                    # Only store if this has a value
+                    if widget.field_type == fitz.PDF_WIDGET_TYPE_RADIOBUTTON:
+                        # For radio buttons, we need to check if it's selected
+                        if hasattr(widget, 'field_flags') and (widget.field_flags & 2**15):
                             field_data[widget.field_name] = widget.field_value
-            
-            # Add to our collective field values
-            all_form_values.update(field_data)
+                    else:
+                        field_data[widget.field_name] = widget.field_value
     
-    # Second step: merge the PDFs with annotations preserved
-    for pdf_base64 in pdf_base64_list:
-        pdf_bytes = base64.b64decode(pdf_base64)
-        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-            # Use the same technique that works in your split function
-            result.insert_pdf(doc, annots=True)
+        # Add to our collective field values
+        all_form_values.update(field_data)
     
-    # Final step: apply collected values to ensure consistent field values
+    return all_form_values
+
+def apply_form_values(result, all_form_values, page_numbers=None):
+    """
+    Re-apply collected form field values to the widgets of result (only on page_numbers if given).
+    """
     # Wait a moment before updating fields (sometimes helps with stability)
     processed_fields = set()
     
-    for page in result:
+    for page_num in (range(len(result)) if page_numbers is None else page_numbers):
+        page = result[page_num]
         for widget in page.widgets():
             field_name = widget.field_name
             if field_name in all_form_values and field_name not in processed_fields:
@@ -253,19 +425,160 @@ def merge_pdfs(pdf_base64_list):
                     
                 except Exception as e:
                     pass  # Skip if there's an issue
+
+def merge_pdfs(pdf_base64_list, manifest=None, linearize=False, image_options=None, image_report=None):
+    """
+    Merge PDFs with fitz, preserving form fields and their values.
+    If a manifest is given, only the listed page ranges are taken, in manifest order:
+      [{"input": 0, "pages": ["1-3", 5], "rotate": 90}, {"input": 1}, ...]
+    Each input is decoded & parsed once, so extract-and-assemble is a single pass.
+    With linearize=True the output is saved linearized (fast web view).
+    With image_options, high resolution images of each input are downsampled first and
+    one bytes-saved report per input is appended to image_report.
+    """
+    result = fitz.open()
+    docs = []
     
-    # Save with settings that are compatible with your PyMuPDF version
-    buffer = BytesIO()
-    result.save(
-        buffer, 
-        garbage=0,  # No garbage collection to avoid removing form elements
-        deflate=True, 
-        clean=False  # Don't clean/remove any elements
-    )
-    buffer.seek(0)
-    merged_pdf_bytes = buffer.read()
+    try:
+        # Open every input document once; they stay open until the merge is done
+        for pdf_base64 in pdf_base64_list:
+            docs.append(fitz.open(stream=base64_to_pdf(pdf_base64), filetype="pdf"))
+        
+        # Without a manifest, take every page of every input in the order given
+        if manifest is None:
+            manifest = [{"input": index} for index in range(len(docs))]
+        elif not isinstance(manifest, list) or not manifest:
+            raise ValueError("Manifest must be a non-empty list of {\"input\", \"pages\", \"rotate\"} entries")
+        
+        # Check every manifest entry before any work is done
+        steps = []
+        for entry in manifest:
+            if not isinstance(entry, dict):
+                raise ValueError(f"Manifest entry {entry!r} must be an object with \"input\", \"pages\" and \"rotate\"")
+            
+            input_index = entry.get('input', 0)
+            if type(input_index) is not int or not 0 <= input_index < len(docs):
+                raise ValueError(f"Manifest input index {input_index!r} does not match any of the {len(docs)} files")
+            
+            # -1 keeps each page's own rotation, anything else sets it absolutely
+            rotate = entry.get('rotate', -1)
+            if type(rotate) is not int or (rotate != -1 and rotate % 90 != 0):
+                raise ValueError(f"Manifest rotation must be -1 or a multiple of 90, got {rotate!r}")
+            
+            doc = docs[input_index]
+            steps.append((doc, rotate, parse_page_ranges(entry.get('pages'), len(doc))))
+        
+        # Downsample the images of all inputs in one batch, before any page gets copied
+        if image_options:
+            reports = downsample_images(docs, image_options)
+            for index, report in enumerate(reports):
+                logging.info(f"Image stage for file {index}: {report}")
+            if image_report is not None:
+                image_report.extend(reports)
+        
+        # First step: collect all form field values from all PDFs
+        all_form_values = collect_form_values(docs)
+        
+        # Second step: assemble the pages listed in the manifest with annotations preserved
+        for doc, rotate, page_ranges in steps:
+            for from_page, to_page in page_ranges:
+                # Use the same technique that works in your split function
+                result.insert_pdf(doc, from_page=from_page, to_page=to_page, rotate=rotate, annots=True)
+        
+        # Final step: apply collected values to ensure consistent field values
+        apply_form_values(result, all_form_values)
+        
+        # Save with settings that are compatible with your PyMuPDF version
+        buffer = BytesIO()
+        result.save(
+            buffer, 
+            garbage=0,  # No garbage collection to avoid removing form elements
+            deflate=True, 
+            clean=False,  # Don't clean/remove any elements
+            linear=linearize  # First-page objects up front for fast web view
+        )
+        buffer.seek(0)
+        merged_pdf_bytes = buffer.read()
+    finally:
+        # Close every document, also when the merge fails halfway
+        for doc in docs:
+            doc.close()
+        result.close()
     
     return base64.b64encode(merged_pdf_bytes).decode("utf-8")
+
+
+
+
+@app.route(route="append_pdf_fitz")
+def append_pdf_fitz(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        load_fitz()
+        # The existing (merged) pdf is in file_content, the pdfs to add to it in append_content
+        req_json = req.get_json()
+        existing_pdf_bytes = base64_to_pdf(req_json['file_content'].get('$content'))
+        pdf_base64_strings_list = [item.get('$content') for item in req_json['append_content']]
+        appended_pdf_base64_string = append_pdfs(existing_pdf_bytes, pdf_base64_strings_list)
+        
+        return func.HttpResponse(
+            body=json.dumps({
+                "$content-type": "application/pdf",
+                "$content": appended_pdf_base64_string
+            }),
+            mimetype="application/json",
+            status_code=200
+        )
+    
+    except Exception as e:
+        logging.exception(f"An error occurred: {str(e)}\n\nTraceback:\n{traceback.format_exc()}")
+        return func.HttpResponse(
+            f"Error: {str(e)}\n\nTraceback:\n{traceback.format_exc()}",
+            status_code=500
+        )
+
+def append_pdfs(existing_pdf_bytes, pdf_base64_list):
+    """
+    Append PDFs to an existing (merged) PDF as an incremental update, merging their form fields
+    into its AcroForm. The original bytes are kept as they are and only the new pages, fields & the
+    changed page tree are written after them, so each append costs the size of the new content.
+    Falls back to a full save when the existing PDF can't be updated incrementally (e.g. it needed repair).
+    """
+    # MuPDF only writes incremental updates to the file a document was opened from
+    with tempfile.TemporaryDirectory() as temp_dir:
+        existing_path = os.path.join(temp_dir, "existing.pdf")
+        with open(existing_path, "wb") as existing_file:
+            existing_file.write(existing_pdf_bytes)
+        
+        result = fitz.open(existing_path)
+        docs = []
+        
+        try:
+            for pdf_base64 in pdf_base64_list:
+                docs.append(fitz.open(stream=base64_to_pdf(pdf_base64), filetype="pdf"))
+            
+            first_new_page = len(result)
+            all_form_values = collect_form_values(docs)
+            
+            for doc in docs:
+                result.insert_pdf(doc, annots=True)
+            
+            # Only touch the new pages, so existing objects stay out of the update
+            apply_form_values(result, all_form_values, range(first_new_page, len(result)))
+            
+            if result.can_save_incrementally():
+                result.save(existing_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+                with open(existing_path, "rb") as existing_file:
+                    pdf_bytes = existing_file.read()
+            else:
+                logging.warning("Existing PDF can't be updated incrementally, rewriting the whole file")
+                pdf_bytes = result.tobytes(garbage=0, deflate=True, clean=False)
+        finally:
+            # Close every document, also when the append fails halfway
+            for doc in docs:
+                doc.close()
+            result.close()
+    
+    return base64.b64encode(pdf_bytes).decode("utf-8")
        
 
          
@@ -277,6 +590,8 @@ def merge_pdfs(pdf_base64_list):
 @app.route(route="split_pdf_pypdf2")
 def split_pdf_pypdf2(req: func.HttpRequest) -> func.HttpResponse: 
     try:
+        # The split helpers resolve to the fitz versions defined further down, so PyPDF2 isn't loaded here
+        load_fitz()
         req_json = req.get_json()
         pdf_bytes = base64_to_pdf(req_json['file_content'].get('$content'))
         page_numbers = req_json.get('pages')
@@ -317,12 +632,12 @@ def pdf_has_text_layer(pdf_bytes: bytes) -> bool:
     Check if the PDF contains a text layer.
     Returns True if text is found, False otherwise.
     """
-    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-    for page_num in range(len(pdf_document)):
-        page = pdf_document.load_page(page_num)
-        text = page.get_text()
-        if text.strip():
-            return True
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        for page_num in range(len(pdf_document)):
+            page = pdf_document.load_page(page_num)
+            text = page.get_text()
+            if text.strip():
+                return True
     return False
 
 def split_pdf_by_page_numbers(pdf_bytes, page_numbers):
@@ -542,18 +857,25 @@ def split_pdf_by_text(pdf_bytes, split_text):
 @app.route(route="split_pdf_fitz")
 def split_pdf_fitz(req: func.HttpRequest) -> func.HttpResponse:
     try:
+        load_fitz()
         req_json = req.get_json()
         pdf_bytes = base64_to_pdf(req_json['file_content'].get('$content'))
         page_numbers = req_json.get('pages')
         split_text = req_json.get('split_text')
         split_regex = req_json.get('split_regex')
+        linearize = bool(req_json.get('linearize', False))
+        image_options = parse_image_options(req_json.get('downsample_images'))
+        
+        # Downsample images once on the source so every part gets the smaller version
+        if image_options:
+            pdf_bytes, image_report = downsample_pdf_images(pdf_bytes, image_options)
         
         if page_numbers:
-            split_base64_strings = split_pdf_by_page_numbers(pdf_bytes, page_numbers)
+            split_base64_strings = split_pdf_by_page_numbers(pdf_bytes, page_numbers, linearize)
         elif split_text or split_regex:
             # Determine if PDF has a text layer
             if pdf_has_text_layer(pdf_bytes):
-                split_base64_strings = split_pdf_by_text(pdf_bytes, split_text, split_regex)
+                split_base64_strings = split_pdf_by_text(pdf_bytes, split_text, split_regex, linearize)
             else:
                 return func.HttpResponse("Text & regex methods do not work on PDFs without text layers. Use a different method or only use on PDFs with text layers.", status_code=400)
         else:
@@ -564,6 +886,7 @@ def split_pdf_fitz(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(
             body=json.dumps(response_data),
             mimetype="application/json",
+            headers={"X-Image-Report": json.dumps([image_report])} if image_options else None,
             status_code=200
         )
 
@@ -585,177 +908,194 @@ def pdf_has_text_layer(pdf_bytes: bytes) -> bool:
     Check if the PDF contains a text layer.
     Returns True if text is found, False otherwise.
     """
-    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-    has_text = False
-    
-    for page_num in range(min(len(pdf_document), 3)):  # Check first 3 pages for efficiency
-        page = pdf_document[page_num]
-        text = page.get_text()
-        if text.strip():
-            has_text = True
-            break
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        has_text = False
+        
+        for page_num in range(min(len(pdf_document), 3)):  # Check first 3 pages for efficiency
+            page = pdf_document[page_num]
+            text = page.get_text()
+            if text.strip():
+                has_text = True
+                break
             
-    pdf_document.close()
     return has_text
 
-def pdf_has_form_fields(pdf_bytes: bytes) -> bool:
+def get_form_fields_info(pdf_bytes):
     """
-    Check if the PDF contains any form fields throughout the entire document.
-    Returns True if any form fields are found, False otherwise.
+    Map form fields to the pages their widgets are on & back.
+    Returns (page_to_fields, field_to_pages) with 0-based page numbers.
     """
-    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-    has_fields = False
-    
-    # Check all pages for form fields
-    for page_num in range(len(pdf_document)):
-        page = pdf_document[page_num]
-        try:
-            widgets = page.widgets()
-            if len(widgets) > 0:
-                has_fields = True
-                break
-        except Exception as e:
-            logging.warning(f"Error checking for widgets on page {page_num}: {str(e)}")
-    
-    # Also check for AcroForm in the PDF catalog
-    try:
-        if "AcroForm" in pdf_document.get_pdf_catalog():
-            has_fields = True
-    except Exception as e:
-        logging.warning(f"Error checking for AcroForm: {str(e)}")
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        # Map fields to pages
+        page_to_fields = defaultdict(set)
+        field_to_pages = defaultdict(set)
+        
+        # Process each page
+        for page_num in range(len(doc)):
+            page = doc[page_num]
+            
+            # Get widgets from the page
+            try:
+                for widget in page.widgets():
+                    try:
+                        field_name = widget.field_name
+                        if field_name:
+                            # Map field to page
+                            page_to_fields[page_num].add(field_name)
+                            field_to_pages[field_name].add(page_num)
+                    except Exception as e:
+                        logging.warning(f"Error processing widget on page {page_num}: {str(e)}")
+            except Exception as e:
+                logging.warning(f"Error accessing widgets on page {page_num}: {str(e)}")
     
-    pdf_document.close()
-    return has_fields
+    return page_to_fields, field_to_pages
 
-def get_form_fields_info(pdf_bytes):
+def trim_part_acroform(doc, part_fields):
     """
-    Extract comprehensive form field information including all metadata.
-    This function creates a more detailed mapping of fields to ensure proper preservation.
+    Reduce the AcroForm of a split part to the fields whose widgets are on its pages.
+    Kids of those fields that sit on pages outside the part are dropped as well, otherwise they
+    pull their pages & the rest of the source form into the part. Field values are kept.
+    The widgets are looked up on the part itself, as inserting pages gives them new xrefs;
+    part_fields (names from get_form_fields_info) is only used to report widgets the index missed.
     """
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    catalog = doc.pdf_catalog()
+    if doc.xref_get_key(catalog, "AcroForm/Fields")[0] != "array":
+        return
     
-    # Map fields to pages
-    page_to_fields = defaultdict(set)
-    field_to_pages = defaultdict(set)
+    def get_parent(xref):
+        kind, value = doc.xref_get_key(xref, "Parent")
+        return int(value.split()[0]) if kind == "xref" else None
     
-    # Extract all field values and properties
-    field_data = {}
+    # Every widget on the part's pages plus the chain of fields above it
+    needed = set()
+    root_fields = []
+    for page in doc:
+        for xref, annot_type, _ in page.annot_xrefs():
+            if annot_type != fitz.PDF_ANNOT_WIDGET:
+                continue
+            
+            chain = [xref]
+            parent = get_parent(xref)
+            while parent and parent not in chain:  # Guard against malformed, cyclic /Parent
+                chain.append(parent)
+                parent = get_parent(parent)
+            
+            name_parts = [doc.xref_get_key(field_xref, "T") for field_xref in reversed(chain)]
+            field_name = ".".join(name for kind, name in name_parts if kind == "string")
+            if field_name and field_name not in part_fields:
+                # A widget on this part's pages is never dropped, even if its name didn't match the index
+                logging.warning(f"Field '{field_name}' is on the part's pages but not in the field index, keeping it")
+            
+            needed.update(chain)
+            if chain[-1] not in root_fields:
+                root_fields.append(chain[-1])
     
-    # Process each page
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        
-        # Get widgets from the page
-        try:
-            for widget in page.widgets():
-                try:
-                    field_name = widget.field_name
-                    if field_name:
-                        # Map field to page
-                        page_to_fields[page_num].add(field_name)
-                        field_to_pages[field_name].add(page_num)
-                        
-                        # Store complete field data
-                        if field_name not in field_data:
-                            field_data[field_name] = {
-                                'value': widget.field_value if hasattr(widget, 'field_value') else None,
-                                'type': widget.field_type if hasattr(widget, 'field_type') else None,
-                                'flags': widget.field_flags if hasattr(widget, 'field_flags') else None,
-                                'rect': widget.rect if hasattr(widget, 'rect') else None,
-                                'appearance': None,  # Will be populated if needed
-                            }
-                except Exception as e:
-                    logging.warning(f"Error processing widget on page {page_num}: {str(e)}")
-        except Exception as e:
-            logging.warning(f"Error accessing widgets on page {page_num}: {str(e)}")
+    # No widgets on this part's pages, so it needs no AcroForm at all
+    if not needed:
+        doc.xref_set_key(catalog, "AcroForm", "null")
+        return
+    
+    for xref in needed:
+        kind, kids = doc.xref_get_key(xref, "Kids")
+        if kind == "array":
+            kept_kids = [kid for kid in map(int, re.findall(r"(\d+) 0 R", kids)) if kid in needed]
+            doc.xref_set_key(xref, "Kids", "[" + " ".join(f"{kid} 0 R" for kid in kept_kids) + "]")
     
-    doc.close()
-    return page_to_fields, field_to_pages, field_data
+    fields_array = "[" + " ".join(f"{xref} 0 R" for xref in root_fields) + "]"
+    kind, acroform = doc.xref_get_key(catalog, "AcroForm")
+    if kind == "xref":
+        doc.xref_set_key(int(acroform.split()[0]), "Fields", fields_array)
+    else:
+        doc.xref_set_key(catalog, "AcroForm/Fields", fields_array)
 
-def process_split_document(pdf_bytes, start_page, end_page):
+def process_split_document(pdf_bytes, start_page, end_page, linearize=False, page_to_fields=None):
     """
     Creates a new document from the specified page range and ensures form fields are preserved.
     Using a different approach to ensure consistent form field preservation across all splits.
+    With linearize=True the part is saved linearized (fast web view).
+    page_to_fields is the field index from get_form_fields_info, built once per request. When the source
+    has fields, the part's AcroForm is trimmed to its own fields & unused objects are dropped on save.
     """
-    # Open the source document
-    source_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    
-    # Create a new document for the page range
-    new_doc = fitz.open()
-    
-    # Insert pages with complete annotations (crucial for form fields)
-    new_doc.insert_pdf(source_doc, from_page=start_page, to_page=end_page, annots=True)
-    
-    # Explicitly handle XFA forms if present
-    try:
-        if hasattr(source_doc, "xref_xml_metadata") and source_doc.xref_xml_metadata > 0:
-            # Copy XFA form data if available
-            if hasattr(new_doc, "set_xml_metadata") and hasattr(source_doc, "xml_metadata"):
-                new_doc.set_xml_metadata(source_doc.xml_metadata)
-    except Exception as e:
-        logging.warning(f"Error handling XFA forms: {str(e)}")
-    
-    # Ensure AcroForm is preserved
-    try:
-        if "AcroForm" in source_doc.get_pdf_catalog():
-            # If there's an AcroForm in the source, make sure we're preserving all form-related elements
-            logging.info("AcroForm found in source document, ensuring preservation")
-    except Exception as e:
-        logging.warning(f"Error checking for AcroForm: {str(e)}")
-    
-    # Save the document with careful settings to preserve all form functionality
-    try:
-        buffer = BytesIO()
-        # Use specific PDF settings that maximize form preservation
-        new_doc.save(
-            buffer, 
-            garbage=0,  # No garbage collection to avoid removing form elements
-            deflate=True, 
-            clean=False,  # Don't clean/remove any elements
-            encryption=False,
-            permissions=int(
-                fitz.PDF_PERM_ACCESSIBILITY |
-                fitz.PDF_PERM_PRINT |
-                fitz.PDF_PERM_COPY |
-                fitz.PDF_PERM_ANNOTATE
-            ),
-            preserve_annots=True,  # IMPORTANT: Ensure annotations are preserved
-            embedded_files=True    # Keep embedded files if any
-        )
-        buffer.seek(0)
-        pdf_bytes = buffer.read()
-    except Exception as e:
-        logging.warning(f"Error saving with options: {str(e)}. Using fallback method.")
+    # Open the source document & create a new document for the page range
+    # Both are closed when leaving the block, also when something fails
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as source_doc, fitz.open() as new_doc:
+        # Insert pages with complete annotations (crucial for form fields)
+        new_doc.insert_pdf(source_doc, from_page=start_page, to_page=end_page, annots=True)
+        
+        # Keep only the fields whose widgets are on this part's pages
+        if page_to_fields:
+            part_fields = set().union(*(page_to_fields.get(page_num, set()) for page_num in range(start_page, end_page + 1)))
+            trim_part_acroform(new_doc, part_fields)
+        
+        # With a trimmed AcroForm every form element is reachable, so garbage collection is safe
+        garbage = 1 if page_to_fields else 0
+        
+        # Explicitly handle XFA forms if present
+        try:
+            if hasattr(source_doc, "xref_xml_metadata") and source_doc.xref_xml_metadata > 0:
+                # Copy XFA form data if available
+                if hasattr(new_doc, "set_xml_metadata") and hasattr(source_doc, "xml_metadata"):
+                    new_doc.set_xml_metadata(source_doc.xml_metadata)
+        except Exception as e:
+            logging.warning(f"Error handling XFA forms: {str(e)}")
+        
+        # Ensure AcroForm is preserved
+        try:
+            if "AcroForm" in source_doc.get_pdf_catalog():
+                # If there's an AcroForm in the source, make sure we're preserving all form-related elements
+                logging.info("AcroForm found in source document, ensuring preservation")
+        except Exception as e:
+            logging.warning(f"Error checking for AcroForm: {str(e)}")
+        
+        # Save the document with careful settings to preserve all form functionality
         try:
-            # Fallback with different options
             buffer = BytesIO()
-            new_doc.save(buffer, garbage=0, clean=False)
+            # Use specific PDF settings that maximize form preservation
+            new_doc.save(
+                buffer, 
+                garbage=garbage,  # No garbage collection on untrimmed forms to avoid removing form elements
+                deflate=True, 
+                clean=False,  # Don't clean/remove any elements
+                encryption=False,
+                permissions=int(
+                    fitz.PDF_PERM_ACCESSIBILITY |
+                    fitz.PDF_PERM_PRINT |
+                    fitz.PDF_PERM_COPY |
+                    fitz.PDF_PERM_ANNOTATE
+                ),
+                preserve_annots=True,  # IMPORTANT: Ensure annotations are preserved
+                embedded_files=True,   # Keep embedded files if any
+                linear=linearize       # First-page objects up front for fast web view
+            )
             buffer.seek(0)
             pdf_bytes = buffer.read()
-        except Exception as e2:
-            logging.warning(f"Fallback method also failed: {str(e2)}. Using tobytes.")
-            pdf_bytes = new_doc.tobytes()
-    
-    # Close both documents to free resources
-    new_doc.close()
-    source_doc.close()
+        except Exception as e:
+            logging.warning(f"Error saving with options: {str(e)}. Using fallback method.")
+            try:
+                # Fallback with different options
+                buffer = BytesIO()
+                new_doc.save(buffer, garbage=garbage, clean=False, linear=linearize)
+                buffer.seek(0)
+                pdf_bytes = buffer.read()
+            except Exception as e2:
+                logging.warning(f"Fallback method also failed: {str(e2)}. Using tobytes.")
+                pdf_bytes = new_doc.tobytes(garbage=garbage, linear=linearize)
     
     return base64.b64encode(pdf_bytes).decode("utf-8")
 
-def split_pdf_by_page_numbers(pdf_bytes, page_numbers):
+def split_pdf_by_page_numbers(pdf_bytes, page_numbers, linearize=False):
     """
     Split PDF by page numbers, preserving form fields and their values.
     Returns a list of base64-encoded PDF documents.
     """
-    # Check if the PDF has form fields (checking ALL pages)
-    has_form_fields = pdf_has_form_fields(pdf_bytes)
-    if has_form_fields:
+    # Build the field-to-page index once (checking ALL pages), every part uses it
+    page_to_fields, field_to_pages = get_form_fields_info(pdf_bytes)
+    if field_to_pages:
         logging.info("PDF contains form fields - using form-preserving splitting")
     
     # Open the document to get total page count
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    total_pages = len(doc)
-    doc.close()
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        total_pages = len(doc)
     
     result_base64_strings = []
     
@@ -782,42 +1122,41 @@ def split_pdf_by_page_numbers(pdf_bytes, page_numbers):
             continue
         
         # Process the document for this page range
-        base64_pdf = process_split_document(pdf_bytes, start_page, end_page)
+        base64_pdf = process_split_document(pdf_bytes, start_page, end_page, linearize, page_to_fields)
         result_base64_strings.append(base64_pdf)
     
     return result_base64_strings
 
-def split_pdf_by_text(pdf_bytes, split_text=None, split_regex=None):
+def split_pdf_by_text(pdf_bytes, split_text=None, split_regex=None, linearize=False):
     """
     Split PDF by exact text occurrence or regex match, preserving form fields and their values.
     Returns a list of base64-encoded PDF documents.
     """
-    has_form_fields = pdf_has_form_fields(pdf_bytes)
-    if has_form_fields:
+    # Build the field-to-page index once (checking ALL pages), every part uses it
+    page_to_fields, field_to_pages = get_form_fields_info(pdf_bytes)
+    if field_to_pages:
         logging.info("PDF contains form fields - using form-preserving splitting")
     
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    total_pages = len(doc)
-    split_pages = [0]  # Start with page 0
-    
-    for page_num in range(total_pages):
-        page = doc[page_num]
-        text = page.get_text()
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        total_pages = len(doc)
+        split_pages = [0]  # Start with page 0
         
-        if split_regex:
-            if re.search(split_regex, text) and page_num > 0:
-                split_pages.append(page_num)
-        elif split_text:
-            if split_text in text and page_num > 0:
-                split_pages.append(page_num)
+        for page_num in range(total_pages):
+            page = doc[page_num]
+            text = page.get_text()
+            
+            if split_regex:
+                if re.search(split_regex, text) and page_num > 0:
+                    split_pages.append(page_num)
+            elif split_text:
+                if split_text in text and page_num > 0:
+                    split_pages.append(page_num)
     
     if split_pages[-1] != total_pages - 1:
         split_pages.append(total_pages)
     else:
         split_pages.append(total_pages)
     
-    doc.close()
-    
     result_base64_strings = []
     for i in range(len(split_pages) - 1):
         start_page = split_pages[i]
@@ -826,7 +1165,405 @@ def split_pdf_by_text(pdf_bytes, split_text=None, split_regex=None):
         if end_page < start_page:
             continue
             
-        base64_pdf = process_split_document(pdf_bytes, start_page, end_page)
+        base64_pdf = process_split_document(pdf_bytes, start_page, end_page, linearize, page_to_fields)
         result_base64_strings.append(base64_pdf)
     
-    return result_base64_strings
\ No newline at end of file
+    return result_base64_strings
+
+
+
+
+
+
+
+
+@app.route(route="render_pdf_thumbnails")
+def render_pdf_thumbnails(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        load_fitz()
+        req_json = req.get_json()
+        pdf_bytes = base64_to_pdf(req_json['file_content'].get('$content'))
+        image_format = str(req_json.get('format', 'png')).lower()
+        output = str(req_json.get('output', 'zip')).lower()
+        try:
+            dpi = int(req_json.get('dpi', THUMBNAIL_DEFAULT_DPI))
+        except (TypeError, ValueError):
+            return func.HttpResponse(f"Invalid. 'dpi' must be a number between 1 and {THUMBNAIL_MAX_DPI}.", status_code=400)
+
+        if image_format not in THUMBNAIL_FORMATS:
+            return func.HttpResponse(f"Invalid. 'format' must be one of {', '.join(THUMBNAIL_FORMATS)}.", status_code=400)
+        if output not in ("zip", "sprite"):
+            return func.HttpResponse("Invalid. 'output' must be 'zip' or 'sprite'.", status_code=400)
+        if not 1 <= dpi <= THUMBNAIL_MAX_DPI:
+            return func.HttpResponse(f"Invalid. 'dpi' must be between 1 and {THUMBNAIL_MAX_DPI}.", status_code=400)
+
+        content_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        page_numbers = resolve_thumbnail_pages(pdf_bytes, req_json.get('pages'))
+
+        if output == "sprite":
+            sprite_bytes, frames = render_thumbnail_sprite(pdf_bytes, content_hash, page_numbers, dpi, image_format)
+            response_data = {
+                "$content-type": THUMBNAIL_FORMATS[image_format],
+                "$content": base64.b64encode(sprite_bytes).decode("utf-8"),
+                "frames": frames
+            }
+        else:
+            images = render_thumbnails(pdf_bytes, content_hash, page_numbers, dpi, image_format)
+            response_data = {
+                "$content-type": "application/zip",
+                "$content": base64.b64encode(build_thumbnail_zip(images, image_format)).decode("utf-8"),
+                "pages": [page_number for page_number, _ in images]
+            }
+
+        return func.HttpResponse(
+            body=json.dumps(response_data),
+            mimetype="application/json",
+            status_code=200
+        )
+
+    except ValueError as e:
+        # Bad input: invalid base64 or PDF signature, pages out of range, sprite too large
+        return func.HttpResponse(f"Invalid. {str(e)}", status_code=400)
+    except Exception as e:
+        logging.exception(f"An error occurred: {str(e)}\n\nTraceback:\n{traceback.format_exc()}")
+        return func.HttpResponse(
+            f"Error: {str(e)}\n\nTraceback:\n{traceback.format_exc()}",
+            status_code=500
+        )
+
+THUMBNAIL_DEFAULT_DPI = 36
+THUMBNAIL_MAX_DPI = 150
+THUMBNAIL_FORMATS = {"png": "image/png", "jpeg": "image/jpeg"}
+THUMBNAIL_CACHE_MAX_BYTES = 256 * 2**20  # Rendered pages & sprites kept per warm worker
+THUMBNAIL_PARALLEL_MIN_PAGES = 8  # Below this, sending pages to worker processes costs more than it saves
+THUMBNAIL_SPRITE_MAX_DIMENSION = 65500  # Largest width/height the JPEG encoder supports
+THUMBNAIL_SPRITE_MAX_PIXELS = 100 * 10**6  # Keeps the uncompressed RGB sprite around 300 MB
+
+# LRU cache of rendered pages keyed by (content hash, page number, dpi, format) and of finished
+# sprites keyed by ("sprite", content hash, pages, dpi, format). Values are (value, size in bytes).
+thumbnail_cache = OrderedDict()
+thumbnail_cache_bytes = 0
+thumbnail_cache_lock = threading.Lock()
+
+def thumbnail_cache_get(key):
+    """
+    Return the cached value for key (marking it as recently used) or None.
+    """
+    with thumbnail_cache_lock:
+        entry = thumbnail_cache.get(key)
+        if entry is None:
+            return None
+        thumbnail_cache.move_to_end(key)
+        return entry[0]
+
+def thumbnail_cache_put(key, value, size):
+    """
+    Cache value under key and evict the least recently used entries until the cache fits
+    THUMBNAIL_CACHE_MAX_BYTES again.
+    """
+    global thumbnail_cache_bytes
+    if size > THUMBNAIL_CACHE_MAX_BYTES:
+        return
+    with thumbnail_cache_lock:
+        previous = thumbnail_cache.pop(key, None)
+        if previous is not None:
+            thumbnail_cache_bytes -= previous[1]
+        thumbnail_cache[key] = (value, size)
+        thumbnail_cache_bytes += size
+        while thumbnail_cache_bytes > THUMBNAIL_CACHE_MAX_BYTES:
+            _, (_, evicted_size) = thumbnail_cache.popitem(last=False)
+            thumbnail_cache_bytes -= evicted_size
+
+def resolve_thumbnail_pages(pdf_bytes, page_numbers):
+    """
+    Check the requested 1-based pages against the PDF. No pages means all pages, each page may be listed once.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        total_pages = len(doc)
+
+    if not page_numbers:
+        return list(range(1, total_pages + 1))
+    if not isinstance(page_numbers, list):
+        raise ValueError("'pages' must be a list of page numbers")
+    for page_number in page_numbers:
+        if type(page_number) is not int or not 1 <= page_number <= total_pages:
+            raise ValueError(f"Page {page_number} is outside of 1-{total_pages}")
+    if len(set(page_numbers)) != len(page_numbers):
+        raise ValueError("'pages' lists a page more than once")
+    return page_numbers
+
+def render_page_images(pdf_bytes, page_numbers, dpi, image_format):
+    """
+    Render the given 1-based pages of a PDF to encoded images.
+    Runs in worker processes, so it loads fitz & opens its own document.
+    """
+    load_fitz()
+    images = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page_number in page_numbers:
+            pix = doc[page_number - 1].get_pixmap(dpi=dpi, alpha=False)
+            images.append(pix.tobytes(image_format))
+    return images
+
+def render_thumbnails(pdf_bytes, content_hash, page_numbers, dpi, image_format):
+    """
+    Render thumbnails for the pages from resolve_thumbnail_pages.
+    Pages already in the render cache are served from it; the rest are rendered in
+    parallel on the shared process pool (MuPDF is not thread safe) and then cached.
+    Returns a list of (page_number, image_bytes) in the requested order.
+    """
+    rendered = {}
+    for page_number in page_numbers:
+        image_bytes = thumbnail_cache_get((content_hash, page_number, dpi, image_format))
+        if image_bytes is not None:
+            rendered[page_number] = image_bytes
+
+    missing_pages = [page_number for page_number in page_numbers if page_number not in rendered]
+
+    if missing_pages:
+        workers = min(os.cpu_count() or 1, len(missing_pages) // THUMBNAIL_PARALLEL_MIN_PAGES)
+        if workers > 1:
+            # Interleave pages across workers so heavy pages are spread out
+            chunks = [missing_pages[i::workers] for i in range(workers)]
+            futures = [get_process_pool().submit(render_page_images, pdf_bytes, chunk, dpi, image_format) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                rendered.update(zip(chunk, future.result()))
+        else:
+            rendered.update(zip(missing_pages, render_page_images(pdf_bytes, missing_pages, dpi, image_format)))
+
+        for page_number in missing_pages:
+            thumbnail_cache_put((content_hash, page_number, dpi, image_format), rendered[page_number], len(rendered[page_number]))
+
+    return [(page_number, rendered[page_number]) for page_number in page_numbers]
+
+def render_thumbnail_sprite(pdf_bytes, content_hash, page_numbers, dpi, image_format):
+    """
+    Render the pages from resolve_thumbnail_pages into a sprite. Finished sprites are cached
+    next to the pages, so a repeat request skips both rendering & compositing.
+    Returns the encoded sprite and its frames.
+    """
+    key = ("sprite", content_hash, tuple(page_numbers), dpi, image_format)
+    sprite = thumbnail_cache_get(key)
+    if sprite is None:
+        images = render_thumbnails(pdf_bytes, content_hash, page_numbers, dpi, image_format)
+        sprite = build_thumbnail_sprite(images, image_format)
+        thumbnail_cache_put(key, sprite, len(sprite[0]))
+    return sprite
+
+def build_thumbnail_zip(images, image_format):
+    """
+    Pack rendered thumbnails into a ZIP archive (page_<n>.<format>).
+    Images are already compressed, so entries are stored rather than deflated.
+    """
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for page_number, image_bytes in images:
+            archive.writestr(f"page_{page_number}.{image_format}", image_bytes)
+    return buffer.getvalue()
+
+def build_thumbnail_sprite(images, image_format):
+    """
+    Lay rendered thumbnails out row by row in a roughly square grid of equal cells in a single sprite image.
+    Returns the encoded sprite and the frame of each page within it.
+    Raises ValueError when the sprite would exceed THUMBNAIL_SPRITE_MAX_DIMENSION or THUMBNAIL_SPRITE_MAX_PIXELS.
+    """
+    pixmaps = [(page_number, fitz.Pixmap(image_bytes)) for page_number, image_bytes in images]
+    cell_width = max(pix.width for _, pix in pixmaps)
+    cell_height = max(pix.height for _, pix in pixmaps)
+
+    columns = min(len(pixmaps), math.ceil(math.sqrt(len(pixmaps) * cell_height / cell_width)))
+    rows = math.ceil(len(pixmaps) / columns)
+    width, height = columns * cell_width, rows * cell_height
+    if max(width, height) > THUMBNAIL_SPRITE_MAX_DIMENSION or width * height > THUMBNAIL_SPRITE_MAX_PIXELS:
+        raise ValueError(
+            f"A sprite of {len(pixmaps)} pages at this dpi would be {width}x{height} pixels, which is too large. "
+            f"Use a lower dpi, fewer pages or the zip output."
+        )
+
+    sprite = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, width, height), False)
+    sprite.clear_with(255)
+
+    frames = []
+    for index, (page_number, pix) in enumerate(pixmaps):
+        if pix.colorspace.n != 3:
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        # Move the thumbnail to its cell, then copy that area into the sprite
+        x, y = index % columns * cell_width, index // columns * cell_height
+        pix.set_origin(x, y)
+        sprite.copy(pix, pix.irect)
+        frames.append({"page": page_number, "x": x, "y": y, "width": pix.width, "height": pix.height})
+
+    return sprite.tobytes(image_format), frames
+
+
+
+
+
+
+
+
+
+IMAGE_DEFAULTS = {
+    "target_dpi": 150,      # Images above threshold_dpi are scaled down to this
+    "threshold_dpi": 225,   # Only images above this effective resolution are touched
+    "jpeg_quality": 75,
+    "detect_gray": True,    # Store color images without visible color as grayscale
+    "detect_bitonal": True  # Store black & white scans as 1-bit, flate compressed images
+}
+IMAGE_GRAY_TOLERANCE = 8  # Max channel difference for a pixel to still count as gray
+IMAGE_BITONAL_MAX_MIDTONES = 0.05  # Max share of midtone pixels for an image to count as bitonal
+IMAGE_MIDTONES = bytes(range(48, 208))
+IMAGE_BIT_TABLE = bytes(ord("0") if value < 128 else ord("1") for value in range(256))  # Gray sample -> bit digit
+
+def parse_image_options(value):
+    """
+    Build the image stage settings from the request's 'downsample_images' value.
+    true uses IMAGE_DEFAULTS, an object overrides individual settings, false/missing disables the stage.
+    """
+    if not value:
+        return None
+
+    options = dict(IMAGE_DEFAULTS)
+    if isinstance(value, dict):
+        unknown = set(value) - set(options)
+        if unknown:
+            raise ValueError(f"Unknown image option(s): {', '.join(sorted(unknown))}")
+        options.update(value)
+
+    if not 1 <= options["jpeg_quality"] <= 100:
+        raise ValueError("'jpeg_quality' must be between 1 and 100")
+    if not 0 < options["target_dpi"] <= options["threshold_dpi"]:
+        raise ValueError("'target_dpi' must be positive and not above 'threshold_dpi'")
+    return options
+
+def recompress_image(image_bytes, scale, options):
+    """
+    Downsample & re-encode a single image. Runs in worker processes, so it loads fitz itself.
+    Scaling a Pixmap leaks its samples in PyMuPDF 1.25, which is why downsample_images always
+    sends images to the pool, whose workers are recycled.
+    Returns (width, height, colorspace, bits_per_component, filter, data) or None if the image can't be decoded.
+    """
+    load_fitz()
+    try:
+        pix = fitz.Pixmap(image_bytes)
+    except Exception:
+        return None
+
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)  # CMYK, Lab etc.
+
+    if scale < 1:
+        pix = fitz.Pixmap(pix, max(1, round(pix.width * scale)), max(1, round(pix.height * scale)), None)
+
+    # Judge color on up to 4096 evenly spread pixels, that is plenty to tell scanned paper from photos
+    if pix.n == 3 and options["detect_gray"]:
+        samples = pix.samples
+        step = 3 * max(1, pix.width * pix.height // 4096)
+        if all(
+            abs(samples[i] - samples[i + 1]) <= IMAGE_GRAY_TOLERANCE and abs(samples[i + 1] - samples[i + 2]) <= IMAGE_GRAY_TOLERANCE
+            for i in range(0, len(samples), step)
+        ):
+            pix = fitz.Pixmap(fitz.csGRAY, pix)
+
+    if pix.n == 1 and options["detect_bitonal"]:
+        samples = pix.samples
+        if len(samples.translate(None, IMAGE_MIDTONES)) >= len(samples) * (1 - IMAGE_BITONAL_MAX_MIDTONES):
+            # Pure black & white compresses far better losslessly than as JPEG, packed 8 pixels
+            # per byte with each row padded to a full byte
+            bits = samples.translate(IMAGE_BIT_TABLE)
+            row_bytes = (pix.width + 7) // 8
+            padding = b"0" * (row_bytes * 8 - pix.width)
+            packed = b"".join(
+                int(bits[y * pix.width:(y + 1) * pix.width] + padding, 2).to_bytes(row_bytes, "big")
+                for y in range(pix.height)
+            )
+            return pix.width, pix.height, "DeviceGray", 1, "FlateDecode", zlib.compress(packed)
+
+    colorspace = "DeviceGray" if pix.n == 1 else "DeviceRGB"
+    return pix.width, pix.height, colorspace, 8, "DCTDecode", pix.tobytes("jpeg", jpg_quality=options["jpeg_quality"])
+
+def downsample_images(docs, options):
+    """
+    Re-encode the images of open documents whose every placement is above options["threshold_dpi"].
+    The images of all documents go to the shared process pool in one batch (MuPDF is not thread
+    safe) and are only replaced when the result is smaller. Returns one bytes-saved report per document.
+    """
+    jobs = []
+    reports = []
+    for doc_index, doc in enumerate(docs):
+        # Effective resolution of each image is taken from its largest placement (lowest DPI),
+        # so no placement ends up below target_dpi
+        image_dpis = {}
+        for page in doc:
+            for image in page.get_images(full=True):
+                xref, smask, width = image[0], image[1], image[2]
+                # Skip images with soft masks, image masks, masks & decode arrays; the re-encoded
+                # samples can't carry them (JPEG) or would no longer match them
+                if smask or doc.xref_get_key(xref, "ImageMask")[1] == "true" or any(
+                    doc.xref_get_key(xref, key)[0] != "null" for key in ("Mask", "Decode")
+                ):
+                    continue
+                dpis = [width / (rect.width / 72) for rect in page.get_image_rects(xref) if rect.width > 0]
+                if dpis:
+                    image_dpis[xref] = min(dpis + [image_dpis.get(xref, math.inf)])
+
+        jobs.extend(
+            (doc_index, xref, options["target_dpi"] / dpi)
+            for xref, dpi in image_dpis.items() if dpi > options["threshold_dpi"]
+        )
+        reports.append({"images_found": len(image_dpis), "images_rewritten": 0, "bytes_before": 0, "bytes_after": 0, "bytes_saved": 0})
+
+    if jobs:
+        job_args = (
+            [docs[doc_index].extract_image(xref)["image"] for doc_index, xref, _ in jobs],
+            [scale for _, _, scale in jobs],
+            [options] * len(jobs)
+        )
+        # Always through the pool, even for a single image, so the Pixmap scaling leak is recycled away
+        results = list(get_process_pool().map(recompress_image, *job_args))
+
+        for (doc_index, xref, _), result in zip(jobs, results):
+            if result is None:
+                continue
+            doc, report = docs[doc_index], reports[doc_index]
+            width, height, colorspace, bits_per_component, image_filter, data = result
+            original_size = len(doc.xref_stream_raw(xref))
+            if len(data) >= original_size:
+                continue
+
+            # Replace the image in place so every page using the xref picks up the new version. Only the
+            # keys describing the samples change, the rest (Intent, Interpolate, OC, Metadata ...) stays
+            stale_keys = [key for key in ("DecodeParms", "SMaskInData") if doc.xref_get_key(xref, key)[0] != "null"]
+            doc.update_stream(xref, data, compress=0)
+            doc.xref_set_key(xref, "Width", str(width))
+            doc.xref_set_key(xref, "Height", str(height))
+            doc.xref_set_key(xref, "ColorSpace", f"/{colorspace}")
+            doc.xref_set_key(xref, "BitsPerComponent", str(bits_per_component))
+            doc.xref_set_key(xref, "Filter", f"/{image_filter}")
+            for key in stale_keys:
+                doc.xref_set_key(xref, key, "null")
+
+            report["images_rewritten"] += 1
+            report["bytes_before"] += original_size
+            report["bytes_after"] += len(data)
+
+    for report in reports:
+        report["bytes_saved"] = report["bytes_before"] - report["bytes_after"]
+    
+    # extract_image & get_image_rects leave the decoded images in MuPDF's store. A small shrink
+    # releases those of already closed documents, which otherwise pile up to the store's 256 MB limit
+    fitz.TOOLS.store_shrink(1)
+    return reports
+
+def downsample_pdf_images(pdf_bytes, options):
+    """
+    Run the image stage on PDF bytes. Returns (pdf_bytes, report).
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        report = downsample_images([doc], options)[0]
+        logging.info(f"Image stage: {report}")
+        if report["images_rewritten"]:
+            pdf_bytes = doc.tobytes(garbage=0, deflate=True)
+    return pdf_bytes, report
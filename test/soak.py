@@ -0,0 +1,220 @@
+"""
+Soak / leak harness for function_app.
+
+Invokes every route in-process thousands of times on synthetic PDFs and tracks
+RSS (of this process & the shared worker pool), open MuPDF documents and Python object counts. Exits with 1 when any of them
+grows past its threshold after warm-up.
+
+PyMuPDF 1.25's C++ Page.annot_xrefs() (also used by page.widgets() and insert_pdf)
+leaks one empty list per call. Those are reported as "leaked_empty_lists" and only
+count towards the object threshold with --strict.
+
+    python test/soak.py --iterations 2000
+"""
+import argparse
+import base64
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import azure.functions as func
+import function_app
+
+
+def make_text_pdf(fitz, pages=6):
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Section {page_num % 3} page {page_num + 1}")
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+def make_form_pdf(fitz, pages=4):
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Form page {page_num + 1}")
+
+        widget = fitz.Widget()
+        widget.field_name = f"name_{page_num}"
+        widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+        widget.rect = fitz.Rect(72, 100, 300, 120)
+        widget.field_value = f"value {page_num}"
+        page.add_widget(widget)
+
+        widget = fitz.Widget()
+        widget.field_name = f"check_{page_num}"
+        widget.field_type = fitz.PDF_WIDGET_TYPE_CHECKBOX
+        widget.rect = fitz.Rect(72, 140, 90, 158)
+        widget.field_value = True
+        page.add_widget(widget)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+def make_scan_pdf(fitz):
+    # A 300 DPI grayscale "scan" on a small page, so the image stage has work to do
+    doc = fitz.open()
+    page = doc.new_page(width=144, height=144)
+    samples = bytes((x * y) % 256 for y in range(600) for x in range(600))
+    page.insert_image(page.rect, pixmap=fitz.Pixmap(fitz.csGRAY, 600, 600, samples, 0))
+    pdf_bytes = doc.tobytes(deflate=True)
+    doc.close()
+    return pdf_bytes
+
+def make_a4_scan_pdf(fitz, dpi=300):
+    # A bitonal A4 text page scanned at dpi. At 300 DPI a scanner's 2480 px on 595.28 pt is 299.96 DPI
+    with fitz.open() as source:
+        page = source.new_page(width=595.28, height=841.89)
+        for line in range(40):
+            page.insert_text((50, 60 + line * 18), f"The quick brown fox jumps over the lazy dog {line}")
+        # Clip to whole scanner pixels (2480x3508 at 300 DPI), MuPDF rounds the full page up
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, clip=fitz.Rect(0, 0, 595.2, 841.92))
+    with fitz.open() as doc:
+        page = doc.new_page(width=595.28, height=841.89)
+        # Stretched over the whole page like a scanner does
+        page.insert_image(page.rect, pixmap=pix, keep_proportion=False)
+        return doc.tobytes(deflate=True)
+
+def check_image_stage(fitz):
+    """
+    Exit unless the image stage brings A4 scans of various resolutions down to the 150 DPI default target.
+    """
+    options = function_app.parse_image_options(True)
+    for scan_dpi in (300, 400, 500, 600):
+        pdf_bytes, report = function_app.downsample_pdf_images(make_a4_scan_pdf(fitz, scan_dpi), options)
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            image = doc.get_page_images(0, full=True)[0]
+            dpi = image[2] / (doc[0].rect.width / 72)
+        if abs(dpi - options["target_dpi"]) > 1:
+            sys.exit(f"image stage left the {scan_dpi} DPI A4 scan at {dpi:.1f} DPI (report {report})")
+        print(f"image stage: {scan_dpi} DPI A4 scan now {dpi:.1f} DPI, {image[5]} {image[4]}-bit, {report['bytes_saved']} bytes saved")
+
+def content(pdf_bytes):
+    return {"$content-type": "application/pdf", "$content": base64.b64encode(pdf_bytes).decode("utf-8")}
+
+def build_calls(fitz):
+    """
+    Return (name, route, body) for every route, covering the main options of each.
+    """
+    text_pdf = content(make_text_pdf(fitz))
+    form_pdf = content(make_form_pdf(fitz))
+    scan_pdf = content(make_scan_pdf(fitz))
+    a4_scan_pdf = content(make_a4_scan_pdf(fitz))
+
+    return [
+        ("detect_pdf_text_layer", function_app.detect_pdf_text_layer, {"file_content": text_pdf}),
+        ("merge_pdf_pypdf2", function_app.merge_pdf_pypdf2, {"file_content": [text_pdf, form_pdf]}),
+        ("merge_pdf_fitz", function_app.merge_pdf_fitz, {"file_content": [text_pdf, form_pdf]}),
+        ("merge_pdf_fitz manifest", function_app.merge_pdf_fitz, {
+            "file_content": [text_pdf, form_pdf],
+            "manifest": [{"input": 1, "pages": ["2-1"], "rotate": 90}, {"input": 0, "pages": [3]}],
+            "linearize": True
+        }),
+        ("merge_pdf_fitz images", function_app.merge_pdf_fitz, {"file_content": [scan_pdf, a4_scan_pdf], "downsample_images": True}),
+        ("append_pdf_fitz", function_app.append_pdf_fitz, {"file_content": form_pdf, "append_content": [text_pdf, form_pdf]}),
+        ("split_pdf_pypdf2", function_app.split_pdf_pypdf2, {"file_content": form_pdf, "pages": [1, 3]}),
+        ("split_pdf_fitz pages", function_app.split_pdf_fitz, {"file_content": form_pdf, "pages": [1, 3], "linearize": True}),
+        ("split_pdf_fitz text", function_app.split_pdf_fitz, {"file_content": text_pdf, "split_text": "Section 0"}),
+        ("split_pdf_fitz regex", function_app.split_pdf_fitz, {"file_content": text_pdf, "split_regex": r"Section [12]"}),
+        ("split_pdf_fitz images", function_app.split_pdf_fitz, {"file_content": scan_pdf, "pages": [1], "downsample_images": True}),
+        ("split_pdf_fitz a4 scan", function_app.split_pdf_fitz, {"file_content": a4_scan_pdf, "pages": [1], "downsample_images": True}),
+        ("render_pdf_thumbnails zip", function_app.render_pdf_thumbnails, {"file_content": text_pdf, "dpi": 24}),
+        ("render_pdf_thumbnails sprite", function_app.render_pdf_thumbnails, {"file_content": form_pdf, "output": "sprite", "format": "jpeg"}),
+        ("prewarm", function_app.prewarm, {}),
+    ]
+
+def invoke(route, body):
+    req = func.HttpRequest(method="POST", url="/api/soak", body=json.dumps(body).encode("utf-8"))
+    return route.build().get_user_function()(req)
+
+def rss_mb(pid="self"):
+    """
+    Current resident set size in MB (peak RSS of this process where /proc is not available).
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if pid == "self" else 0
+
+def measure(fitz):
+    gc.collect()
+    objects = gc.get_objects()
+    empty_lists = sum(1 for obj in objects if type(obj) is list and not obj)
+    return {
+        "rss_mb": round(rss_mb(), 1),
+        # Worker processes of function_app's shared process pool
+        "worker_rss_mb": round(sum(rss_mb(child.pid) for child in multiprocessing.active_children()), 1),
+        "open_documents": sum(1 for obj in objects if isinstance(obj, fitz.Document) and not obj.is_closed),
+        "python_objects": len(objects) - empty_lists,
+        "leaked_empty_lists": empty_lists,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000, help="rounds over all routes after warm-up")
+    parser.add_argument("--warmup", type=int, default=50, help="rounds before the baseline is taken")
+    parser.add_argument("--sample-every", type=int, default=250, help="rounds between measurements")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=64)
+    parser.add_argument("--max-object-growth", type=int, default=5000)
+    parser.add_argument("--max-open-documents", type=int, default=0)
+    parser.add_argument("--strict", action="store_true", help="count empty lists towards the object threshold")
+    args = parser.parse_args()
+
+    # The handlers log warnings for some inputs, which would drown the report
+    logging.disable(logging.WARNING)
+
+    fitz = function_app.load_fitz()
+    check_image_stage(fitz)
+    calls = build_calls(fitz)
+
+    def run_round():
+        for name, route, body in calls:
+            response = invoke(route, body)
+            if response.status_code != 200:
+                sys.exit(f"{name} failed with {response.status_code}: {response.get_body()[:500]!r}")
+
+    for _ in range(args.warmup):
+        run_round()
+
+    baseline = measure(fitz)
+    print(f"baseline after {args.warmup} warm-up rounds: {baseline}")
+
+    start = time.perf_counter()
+    for iteration in range(1, args.iterations + 1):
+        run_round()
+        if iteration % args.sample_every == 0 or iteration == args.iterations:
+            print(f"round {iteration}: {measure(fitz)} ({time.perf_counter() - start:.0f}s)")
+
+    final = measure(fitz)
+    failures = []
+    if final["rss_mb"] - baseline["rss_mb"] > args.max_rss_growth_mb:
+        failures.append(f"RSS grew by {final['rss_mb'] - baseline['rss_mb']:.1f} MB")
+    if final["worker_rss_mb"] - baseline["worker_rss_mb"] > args.max_rss_growth_mb:
+        failures.append(f"worker RSS grew by {final['worker_rss_mb'] - baseline['worker_rss_mb']:.1f} MB")
+    object_growth = final["python_objects"] - baseline["python_objects"]
+    if args.strict:
+        object_growth += final["leaked_empty_lists"] - baseline["leaked_empty_lists"]
+    if object_growth > args.max_object_growth:
+        failures.append(f"Python objects grew by {object_growth}")
+    if final["open_documents"] > args.max_open_documents:
+        failures.append(f"{final['open_documents']} MuPDF documents left open")
+
+    if failures:
+        print("FAIL: " + "; ".join(failures))
+        return 1
+    print(f"OK: {args.iterations} rounds of {len(calls)} calls")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())